@@ -2,10 +2,25 @@ from app.database import db
 import asyncio
 
 async def check_channels():
-    missing_name = await db.channels.find({"channel_name": {"$exists": False}}).to_list(10)
-    missing_fields = await db.channels.find({"fields": {"$exists": False}}).to_list(10)
+    # Bare connection: no index builds or ingest buffer, the data may not satisfy them yet
+    await db.connect_to_mongodb(init_app=False)
+
+    # One query for both checks, projecting only what's needed to classify each document
+    cursor = db.channels.find(
+        {"$or": [{"channel_name": {"$exists": False}}, {"fields": {"$exists": False}}]},
+        {"_id": 1, "channel_name": 1, "fields": 1}
+    )
+    missing_name = []
+    missing_fields = []
+    async for doc in cursor:
+        if "channel_name" not in doc and len(missing_name) < 10:
+            missing_name.append(doc)
+        if "fields" not in doc and len(missing_fields) < 10:
+            missing_fields.append(doc)
 
     print("Documents missing channel_name:", missing_name)
     print("Documents missing fields:", missing_fields)
 
+    await db.close_mongodb_connection()
+
 asyncio.run(check_channels())
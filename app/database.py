@@ -1,22 +1,57 @@
 # /Users/joemarian/water-tank/app/database.py
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
+from pymongo.errors import OperationFailure
+from pymongo.server_api import ServerApi
 import os
 from dotenv import load_dotenv
+from app.ingest_buffer import ingest_buffer
 
 load_dotenv()
 
+# Key spec of the data index every latest/historical read walks; also used as the query hint
+DATA_TS_INDEX = [("tank_id", 1), ("timestamp", -1)]
+
 class Database:
     client: AsyncIOMotorClient = None
     db = None
     channels = None
     data = None
+    data_fast = None
+    # Set once the unique channel_name index is known to exist; until then
+    # create_channel checks for duplicates itself
+    channel_name_unique = False
 
-    async def connect_to_mongodb(self):
+    async def connect_to_mongodb(self, init_app: bool = True):
+        """
+        Connects the client and binds the collections. With init_app (the server
+        processes), it also ensures the indexes and starts the ingest buffer;
+        maintenance scripts pass init_app=False to get a bare connection.
+        """
         MONGO_URI = os.getenv("MONGO_URI")
         if not MONGO_URI:
             raise ValueError("MONGO_URI environment variable not set.")
         print(f"Connecting to MongoDB with URI: {MONGO_URI}") # Added for better logging
-        self.client = AsyncIOMotorClient(MONGO_URI)
+        # Connection pool and wire settings, overridable per deployment:
+        #   MONGO_MAX_POOL / MONGO_MIN_POOL - sockets per process (per uvicorn worker),
+        #                                     shared by the HTTP routes, CoAP and MQTT
+        #   MONGO_MAX_IDLE_MS               - idle sockets above the minimum are closed after this
+        #   MONGO_W                         - default write concern ("majority", "1", ...)
+        # zstd/snappy compression is used when the server supports it and the
+        # pymongo extras are installed; otherwise pymongo falls back to no compression.
+        write_concern = os.getenv("MONGO_W", "majority")
+        self.client = AsyncIOMotorClient(
+            MONGO_URI,
+            maxPoolSize=int(os.getenv("MONGO_MAX_POOL", 50)),
+            minPoolSize=int(os.getenv("MONGO_MIN_POOL", 5)),
+            maxIdleTimeMS=int(os.getenv("MONGO_MAX_IDLE_MS", 60000)),
+            waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2500)),
+            serverSelectionTimeoutMS=3000,
+            compressors="zstd,snappy",
+            retryWrites=True,
+            server_api=ServerApi("1"),
+            w=int(write_concern) if write_concern.isdigit() else write_concern
+        )
         
         # --- CRITICAL CHANGE HERE ---
         # Get the database object directly from the client. It will use the database name
@@ -27,12 +62,52 @@ class Database:
         # --- END CRITICAL CHANGE ---
 
         self.channels = self.db.channels
-        self.data = self.db.data
+        # Sensor data is high-volume and individually low-value, so it only waits for
+        # the primary's acknowledgement (MONGO_DATA_W, default 1) without a journal
+        # sync; channel metadata keeps the client-wide write concern above.
+        data_w = os.getenv("MONGO_DATA_W", "1")
+        self.data = self.db.data.with_options(
+            write_concern=WriteConcern(w=int(data_w) if data_w.isdigit() else data_w, j=False)
+        )
+        # Unacknowledged (w=0) handle on the same collection for device telemetry over
+        # CoAP/MQTT: the driver doesn't wait for any server reply, so insert errors are
+        # not reported back. Channel provisioning never goes through this handle.
+        self.data_fast = self.db.get_collection("data", write_concern=WriteConcern(w=0))
         await self.db.command("ping") # Add this to test the connection immediately
         print("MongoDB connected successfully!")
+        pool_options = self.client.delegate.options.pool_options
+        print(f"MongoDB pool: maxPoolSize={pool_options.max_pool_size}, minPoolSize={pool_options.min_pool_size}; "
+              f"topology: {self.client.topology_description}")
+
+        if init_app:
+            await self.ensure_indexes()
+            ingest_buffer.start(self.data)
+
+    async def ensure_indexes(self):
+        # Indexes backing the hot read paths: every latest/historical query filters
+        # on tank_id and sorts on timestamp, and channel lookups go by channel_name.
+        # The unique index also makes insert_one the authoritative duplicate check.
+        await self.data.create_index(DATA_TS_INDEX, background=True)
+        # Legacy documents without channel_name (see fix_channels.py) are left out of the
+        # unique index instead of colliding as nulls. If existing data still has duplicate
+        # names the build fails; that is reported instead of stopping the process.
+        try:
+            await self.channels.create_index(
+                "channel_name", unique=True, background=True,
+                partialFilterExpression={"channel_name": {"$exists": True}}
+            )
+            self.channel_name_unique = True
+        except OperationFailure as e: # DuplicateKeyError is a subclass
+            self.channel_name_unique = False
+            print(f"Warning: could not build the unique channel_name index ({e}). "
+                  "Channel creation falls back to a duplicate check without it; "
+                  "run app/check_channels.py to find duplicate or legacy channel documents.")
+        print("MongoDB indexes ensured.")
 
     async def close_mongodb_connection(self):
         if self.client:
+            # Buffered data writes must land before the client goes away
+            await ingest_buffer.flush()
             print("Closing MongoDB connection...")
             self.client.close()
             print("MongoDB connection closed.")
@@ -2,10 +2,19 @@ from app.database import db
 import asyncio
 
 async def fix_channel_names():
+    # Bare connection: no index builds or ingest buffer, the data may not satisfy them yet
+    await db.connect_to_mongodb(init_app=False)
+
+    # Partial index over legacy documents only, so the update below touches just those
+    # instead of scanning the whole collection
+    await db.channels.create_index("name", partialFilterExpression={"name": {"$exists": True}})
+
     result = await db.channels.update_many(
         {"channel_name": {"$exists": False}, "name": {"$exists": True}},
         {"$rename": {"name": "channel_name"}}
     )
     print(f"Renamed {result.modified_count} documents.")
 
+    await db.close_mongodb_connection()
+
 asyncio.run(fix_channel_names())
@@ -0,0 +1,80 @@
+import asyncio
+from typing import Any, Dict, List
+
+# A batch is written as soon as it reaches FLUSH_SIZE documents or FLUSH_INTERVAL
+# seconds after its first document arrived, whichever comes first.
+FLUSH_INTERVAL = 0.05  # seconds
+FLUSH_SIZE = 500
+# Most documents that may wait in memory. Once full, put() blocks, so slow or
+# unavailable MongoDB pushes back on writers instead of growing the queue unbounded.
+MAX_PENDING = 10_000
+
+_STOP = object()
+
+class IngestBuffer:
+    """
+    Collects data documents in memory and writes them to MongoDB in batches
+    with insert_many(ordered=False), amortizing one round-trip over many writes.
+
+    Durability trade-off: a buffered write is acknowledged to the client before it
+    reaches MongoDB. If the process dies, everything still queued is lost: up to
+    MAX_PENDING documents, more than FLUSH_INTERVAL worth whenever MongoDB is slow
+    or down. A batch whose insert_many fails is logged and dropped, not retried.
+    Callers that need the write confirmed should insert directly.
+    """
+    def __init__(self):
+        self.collection = None
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+
+    def start(self, collection):
+        """Starts the background consumer writing into the given collection."""
+        self.collection = collection
+        self._queue = asyncio.Queue(maxsize=MAX_PENDING)
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, doc: Dict[str, Any]):
+        """Queues a document, waiting while MAX_PENDING documents are already queued."""
+        await self._queue.put(doc)
+
+    async def flush(self):
+        """Writes out everything still queued and stops the consumer."""
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            doc = await self._queue.get()
+            if doc is _STOP:
+                break
+            batch = [doc]
+            deadline = loop.time() + FLUSH_INTERVAL
+            while len(batch) < FLUSH_SIZE:
+                try:
+                    doc = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        doc = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if doc is _STOP:
+                    stopping = True
+                    break
+                batch.append(doc)
+            await self._write(batch)
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+        except Exception as e:
+            print(f"Error writing {len(batch)} buffered data documents: {e}")
+
+ingest_buffer = IngestBuffer()
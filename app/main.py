@@ -4,12 +4,12 @@ import os
 import json
 import asyncio
 import uuid
-from datetime import datetime
-from typing import Dict, Any
-from coap_server import coap_main
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 from fastapi import FastAPI, HTTPException
+from pymongo import InsertOne
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from dotenv import load_dotenv
 
 # --- MODIFIED load_dotenv CALL ---
@@ -25,12 +25,12 @@ print(f"DEBUG: MONGO_URI from .env is: {os.getenv('MONGO_URI')}") # Keep this de
 
 from app.routes import channels, data
 from app.database import db
-
-import paho.mqtt.client as mqtt
+from app.utils import lookup_channel_by_name
 
 app = FastAPI(
     title="Water Tank Management",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse # orjson serializes datetimes natively and much faster
 )
 
 # ... rest of your main.py ...
@@ -41,7 +41,7 @@ app.include_router(channels.router, prefix="/api/channels")
 app.include_router(data.router, prefix="/api/data", tags=["Data"])
 
 # --- MQTT Integration (using paho-mqtt) ---
-mqtt_client: mqtt.Client = None
+mqtt_client = None # paho.mqtt.client.Client, created in startup_event
 main_event_loop = None # New: Global variable to hold the main event loop
 
 MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
@@ -49,6 +49,18 @@ MQTT_BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))
 MQTT_USERNAME = os.getenv("MQTT_USERNAME")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
+# Incoming MQTT messages are queued by the paho thread and written in batches by
+# _mqtt_flush_loop on the event loop, every MQTT_FLUSH_INTERVAL seconds or as soon
+# as MQTT_FLUSH_SIZE messages are waiting.
+MQTT_FLUSH_INTERVAL = 0.1 # seconds
+MQTT_FLUSH_SIZE = 500
+MQTT_BULK_CHUNK = 1000 # max InsertOne ops per bulk_write, keeps each OP_MSG well under 48MB
+_mqtt_buffer = deque() # (channel_name, received_at, payload); append/popleft are thread-safe
+_mqtt_wakeup: asyncio.Event = None
+_mqtt_flush_task: asyncio.Task = None
+_mqtt_stopping = False # set by shutdown; the flush loop drains the buffer once more and exits
+_UTC = timezone.utc # Bound once; on_message timestamps every message
+
 
 
 def on_connect(client, userdata, flags, rc, properties):
@@ -60,51 +72,97 @@ def on_connect(client, userdata, flags, rc, properties):
         print(f"Failed to connect to MQTT Broker, return code {rc}")
 
 def on_message(client, userdata, msg):
-    print(f"Received MQTT message on topic '{msg.topic}': {msg.payload.decode()}")
+    # The text form is only for logging; errors='replace' keeps bad UTF-8 from raising here
+    payload_text = msg.payload.decode(errors='replace')
+    print(f"Received MQTT message on topic '{msg.topic}': {payload_text}")
     try:
-        data_payload = json.loads(msg.payload.decode())
+        # json.loads detects the encoding of the raw bytes itself, no intermediate str needed
+        data_payload = json.loads(msg.payload)
         topic_parts = msg.topic.split('/')
-        if len(topic_parts) >= 2:
+        if not isinstance(data_payload, dict):
+            print(f"Error: MQTT payload from topic '{msg.topic}' is not a JSON object. Skipping.")
+        elif len(topic_parts) >= 2:
             channel_name = topic_parts[1]
-            # IMPORTANT CHANGE: Use run_coroutine_threadsafe to submit to the main loop
             if main_event_loop and main_event_loop.is_running():
-                asyncio.run_coroutine_threadsafe(save_mqtt_data(channel_name, data_payload), main_event_loop)
+                # Only queue the message here; the flush loop does the database work.
+                # The loop is woken early once a full batch is waiting.
+                _mqtt_buffer.append((channel_name, datetime.now(_UTC), data_payload))
+                if len(_mqtt_buffer) >= MQTT_FLUSH_SIZE:
+                    main_event_loop.call_soon_threadsafe(_mqtt_wakeup.set)
             else:
                 print("Error: Main event loop not running or not available. Cannot process MQTT message.")
         else:
             print(f"Invalid MQTT topic format received: {msg.topic}")
 
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON payload from topic '{msg.topic}': {msg.payload.decode()}")
+    except ValueError: # JSONDecodeError, or UnicodeDecodeError for undecodable bytes
+        print(f"Error: Invalid JSON payload from topic '{msg.topic}': {payload_text}")
     except Exception as e:
         print(f"Error processing MQTT message for topic '{msg.topic}': {e}")
 
-async def save_mqtt_data(channel_name: str, data: Dict[str, Any]):
-    if db.channels is None or db.data is None:
-        print("Database connection not yet initialized. Skipping MQTT data save.")
+async def _mqtt_flush_loop():
+    # Never cancelled mid-flush: messages already popped from the buffer would be lost
+    while True:
+        try:
+            await asyncio.wait_for(_mqtt_wakeup.wait(), MQTT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _mqtt_wakeup.clear()
+        stopping = _mqtt_stopping # read before flushing, so the last pass sees every message
+        try:
+            await flush_mqtt_buffer()
+        except Exception as e:
+            print(f"Error flushing MQTT data: {e}")
+        if stopping:
+            break
+
+async def flush_mqtt_buffer():
+    """Drains queued MQTT messages and writes them with unordered bulk_write calls."""
+    if not _mqtt_buffer:
         return
-
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        print(f"Channel '{channel_name}' not found. Please create the channel via API first. Skipping MQTT data save.")
+    if db.channels is None or db.data_fast is None:
+        print("Database connection not yet initialized. Skipping MQTT data save.")
         return
 
-    allowed_fields = set(channel.get("fields", []))
-    cleaned_data = {}
-    for key, value in data.items():
-        if key in allowed_fields:
-            cleaned_data[key] = value
-        else:
-            print(f"Warning: Field '{key}' from MQTT not defined for channel '{channel_name}'. Skipping.")
-
-    data_entry = {
-        "_id": str(uuid.uuid4()),
-        "tank_id": channel_name,
-        "timestamp": datetime.utcnow(),
-        **cleaned_data
-    }
-    await db.data.insert_one(data_entry)
-    print(f"MQTT data saved successfully for channel '{channel_name}': {cleaned_data}")
+    by_channel = defaultdict(list)
+    for _ in range(len(_mqtt_buffer)):
+        channel_name, received_at, data = _mqtt_buffer.popleft()
+        by_channel[channel_name].append((received_at, data))
+
+    data_entries = []
+    written_channels = 0
+    for channel_name, messages in by_channel.items():
+        # One (usually cached) channel lookup per channel per batch
+        channel = await lookup_channel_by_name(channel_name)
+        if channel is None:
+            print(f"Channel '{channel_name}' not found. Please create the channel via API first. Skipping {len(messages)} MQTT message(s).")
+            continue
+
+        written_channels += 1
+        allowed_fields = channel.field_set
+        for received_at, data in messages:
+            cleaned_data = {}
+            for key, value in data.items():
+                if key in allowed_fields:
+                    cleaned_data[key] = value
+                else:
+                    print(f"Warning: Field '{key}' from MQTT not defined for channel '{channel_name}'. Skipping.")
+
+            data_entries.append({
+                "_id": str(uuid.uuid4()),
+                "tank_id": channel_name,
+                "timestamp": received_at,
+                **cleaned_data
+            })
+
+    if data_entries:
+        # Unacknowledged telemetry write. pymongo refuses bypass_document_validation
+        # on w=0 writes, and the data collection has no validator to bypass anyway.
+        for start in range(0, len(data_entries), MQTT_BULK_CHUNK):
+            await db.data_fast.bulk_write(
+                [InsertOne(d) for d in data_entries[start:start + MQTT_BULK_CHUNK]],
+                ordered=False
+            )
+        print(f"MQTT data saved successfully: {len(data_entries)} message(s) across {written_channels} channel(s)")
 
 @app.on_event("startup")
 async def startup_event():
@@ -115,8 +173,17 @@ async def startup_event():
     global main_event_loop
     main_event_loop = asyncio.get_event_loop()
 
+    global _mqtt_wakeup, _mqtt_flush_task
+    _mqtt_wakeup = asyncio.Event()
+    _mqtt_flush_task = asyncio.create_task(_mqtt_flush_loop())
+
+    # coap_server (and aiocoap) and paho-mqtt are imported here rather than at module
+    # level, so importing app.main and building the FastAPI app stays cheap
+    #from coap_server import coap_main
     #asyncio.create_task(coap_main())
 
+    import paho.mqtt.client as mqtt
+
     global mqtt_client
     mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 
@@ -138,7 +205,6 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     print("Application shutdown event triggered.")
-    await db.close_mongodb_connection()
 
     if mqtt_client:
         print("Stopping MQTT client loop and disconnecting...")
@@ -146,6 +212,16 @@ async def shutdown_event():
         mqtt_client.disconnect()
         print("MQTT client disconnected.")
 
+    # Write out whatever MQTT data is still queued before the database goes away: the
+    # flush loop finishes its current batch, drains the buffer once more and exits
+    global _mqtt_stopping
+    if _mqtt_flush_task:
+        _mqtt_stopping = True
+        _mqtt_wakeup.set()
+        await _mqtt_flush_task
+
+    await db.close_mongodb_connection()
+
 @app.get("/")
 def read_root():
     file_path = os.path.join("app", "static", "dashboard.html")
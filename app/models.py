@@ -12,6 +12,13 @@ class ChannelCreate(BaseModel):
     fields: List[str]
     initial_values: Optional[Dict[str, Any]] = None
 
+class ChannelUpdate(BaseModel):
+    """
+    Pydantic model for adding or removing fields on an existing channel.
+    """
+    add_fields: Optional[List[str]] = []
+    remove_fields: Optional[List[str]] = []
+
 class ChannelOut(BaseModel):
     """
     Pydantic model for the output of a created or retrieved channel.
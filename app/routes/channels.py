@@ -1,31 +1,63 @@
 from fastapi import APIRouter, HTTPException, Query, Body, status, Request # Added Request
-from typing import List, Optional, Dict, Any
-from app.database import db # Assuming your db connection is in database.py
-import string
-import random
-import datetime # Ensure datetime is imported
-from pydantic import BaseModel # Added: Import BaseModel from pydantic
+from typing import Literal, Optional, Dict, Any
+import asyncio
+from app.database import db, DATA_TS_INDEX # Assuming your db connection is in database.py
+from app.ingest_buffer import MAX_PENDING, ingest_buffer
+from app.utils import auth_channel, channel_exists, coerce_value, generate_api_key, invalidate
+from datetime import datetime as _dt, timezone
+from app.models import ChannelCreate, ChannelUpdate
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
 
 router = APIRouter(tags=["channels"])
 
-def generate_api_key(length=12):
-    """Generates a random API key of specified length."""
-    chars = string.ascii_uppercase + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
-
-class ChannelCreate(BaseModel):
-    """Pydantic model for creating a new channel."""
-    channel_name: str
-    fields: List[str]
-    initial_values: Optional[Dict[str, Any]] = None
+# Bound once so the write paths skip the module attribute lookups per request
+_UTC = timezone.utc
+
+WritePolicy = Literal["buffered", "sync"]
+_RESERVED_QUERY_PARAMS = frozenset(("api_key", "write_policy"))
+_WRITE_POLICY_DESCRIPTION = (
+    "'buffered' acknowledges before the insert and batches it (~50ms lag); queued writes "
+    f"(up to {MAX_PENDING:,}) are lost if the server process dies, and a batch whose insert "
+    "fails is dropped with only a server-side log. 'sync' waits for MongoDB and reports errors."
+)
+
+async def _store_data(data_doc: Dict[str, Any], write_policy: WritePolicy):
+    """Inserts a data document directly or hands it to the batching ingest buffer."""
+    if write_policy == "sync":
+        await db.data.insert_one(data_doc)
+    else:
+        await ingest_buffer.put(data_doc)
 
-class DataWrite(BaseModel):
-    """Pydantic model for writing data to a channel.
-    This model allows for dynamic fields based on the channel's configuration.
+async def _stream_json_array(cursor, prefetched=()):
+    """
+    Yields the documents of a cursor as the chunks of one JSON array, starting with
+    any documents already pulled from it.
+    """
+    separator = b"["
+    for doc in prefetched:
+        yield separator + orjson.dumps(doc)
+        separator = b","
+    async for doc in cursor:
+        yield separator + orjson.dumps(doc)
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+def _history_cursor(query: Dict[str, Any], projection: Dict[str, int], limit: int):
     """
-    # The actual fields will be validated dynamically based on the channel's 'fields'
-    # This model acts as a placeholder for the arbitrary data dictionary.
-    data: Dict[str, Any]
+    Builds the historical data cursor, sorted by timestamp and limited server-side.
+    The hint pins the compound index so a wide time range can't be planned as a
+    collection scan, and allow_disk_use=False makes a regression fail loudly
+    instead of silently spilling an in-memory sort to disk.
+    """
+    return (
+        db.data.find(query, projection, allow_disk_use=False)
+        .sort("timestamp", 1)
+        .hint(DATA_TS_INDEX)
+        .limit(limit)
+    )
 
 @router.post("/", status_code=status.HTTP_201_CREATED, summary="Create a new channel")
 async def create_channel(channel: ChannelCreate):
@@ -34,10 +66,6 @@ async def create_channel(channel: ChannelCreate):
     If initial values are provided, they are inserted as the first data entry
     with a timestamp.
     """
-    existing = await db.channels.find_one({"channel_name": channel.channel_name})
-    if existing:
-        raise HTTPException(status_code=400, detail="Channel already exists")
-
     api_key = generate_api_key()
 
     channel_doc = {
@@ -45,12 +73,19 @@ async def create_channel(channel: ChannelCreate):
         "api_key": api_key,
         "fields": channel.fields
     }
-    await db.channels.insert_one(channel_doc)
+    # The unique index on channel_name rejects duplicates. If it couldn't be built at
+    # startup (existing duplicate/legacy documents), check explicitly instead.
+    if not db.channel_name_unique and await channel_exists(channel.channel_name):
+        raise HTTPException(status_code=400, detail="Channel already exists")
+    try:
+        await db.channels.insert_one(channel_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Channel already exists")
 
     # Insert initial values as the first data document with a timestamp
     data_to_insert = {
         "tank_id": channel.channel_name,
-        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+        "timestamp": _dt.now(_UTC)
     }
     if channel.initial_values:
         # Filter initial_values to only include fields defined for the channel
@@ -75,55 +110,65 @@ async def create_channel(channel: ChannelCreate):
 @router.get("/", summary="List all channels")
 async def list_channels():
     """Retrieves a list of all available channels."""
-    channels = await db.channels.find().to_list(100)
-    return [{"channel_name": c["channel_name"], "fields": c["fields"]} for c in channels]
+    # Project on the server so API keys and ObjectIds never leave MongoDB
+    channels = await db.channels.find({}, {"_id": 0, "channel_name": 1, "fields": 1}).to_list(100)
+    return ORJSONResponse(channels)
 
 @router.get("/{channel_name}", summary="Get channel details")
 async def get_channel(channel_name: str, api_key: str = Query(..., description="API key for authentication")):
     """Retrieves details for a specific channel, including its API key and fields."""
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    channel = await auth_channel(channel_name, api_key)
     return {
-        "channel_name": channel["channel_name"],
-        "api_key": channel["api_key"],
-        "fields": channel["fields"]
+        "channel_name": channel_name,
+        "api_key": channel.api_key,
+        "fields": list(channel.fields)
     }
 
-@router.post("/{channel_name}/data", status_code=status.HTTP_201_CREATED, summary="Write data to a channel (JSON Body)")
+@router.post(
+    "/{channel_name}/data",
+    status_code=status.HTTP_201_CREATED,
+    summary="Write data to a channel (JSON Body)",
+    # The body is parsed by hand below; this keeps it documented in /docs
+    openapi_extra={"requestBody": {
+        "required": True,
+        "description": "Dictionary of field-value pairs to write",
+        "content": {"application/json": {"schema": {"type": "object", "additionalProperties": True}}}
+    }}
+)
 async def write_data(
     channel_name: str,
+    request: Request,
     api_key: str = Query(..., description="API key for authentication"),
-    data: Dict[str, Any] = Body(..., description="Dictionary of field-value pairs to write")
+    write_policy: WritePolicy = Query("buffered", description=_WRITE_POLICY_DESCRIPTION)
 ):
     """
     Writes new data to a specific channel using a JSON request body.
     Each write creates a new historical record with a timestamp.
     Only fields defined for the channel will be stored.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    # Highest-QPS endpoint: parse the body with orjson and check its shape by hand
+    # instead of going through Pydantic validation
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body.")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object of field-value pairs.")
+
+    channel = await auth_channel(channel_name, api_key)
 
     # Prepare the data document, including only valid fields
     data_doc = {
         "tank_id": channel_name,
-        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+        "timestamp": _dt.now(_UTC)
     }
-    channel_fields = set(channel.get("fields", []))
+    channel_fields = channel.field_set
 
     valid_field_found = False
     for field, value in data.items():
         if field in channel_fields:
-            # Attempt to convert to float if it looks like a number, otherwise store as is
-            try:
-                data_doc[field] = float(value)
-            except (ValueError, TypeError): # Catch TypeError for non-string types as well
-                data_doc[field] = value
+            # Stored as float if it looks like a number, otherwise as is
+            data_doc[field] = coerce_value(value)
             valid_field_found = True
         else:
             print(f"Warning: Field '{field}' not defined for channel '{channel_name}'. Ignoring.")
@@ -132,14 +177,15 @@ async def write_data(
         # If no valid fields were provided in the data, raise an error
         raise HTTPException(status_code=400, detail="No valid channel fields provided in data.")
 
-    await db.data.insert_one(data_doc)
+    await _store_data(data_doc, write_policy)
     return {"message": "Data written successfully (JSON Body)", "timestamp": data_doc["timestamp"]}
 
 
 @router.get("/{channel_name}/update", status_code=status.HTTP_200_OK, summary="Write data to a channel (URL Query Params)")
 async def update_channel_data_by_query_params(
     channel_name: str,
-    request: Request # Inject the Request object to access query parameters dynamically
+    request: Request, # Inject the Request object to access query parameters dynamically
+    write_policy: WritePolicy = Query("buffered", description=_WRITE_POLICY_DESCRIPTION)
 ):
     """
     Writes new data to a specific channel using URL query parameters.
@@ -151,29 +197,22 @@ async def update_channel_data_by_query_params(
     if not api_key:
         raise HTTPException(status_code=400, detail="API key is required in query parameters.")
 
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    channel = await auth_channel(channel_name, api_key)
 
     data_to_insert = {
         "tank_id": channel_name,
-        "timestamp": datetime.datetime.now(datetime.timezone.utc)
+        "timestamp": _dt.now(_UTC)
     }
-    channel_fields = set(channel.get("fields", []))
+    channel_fields = channel.field_set
     found_valid_field = False
 
     # Iterate through all query parameters
     for field, value in request.query_params.items():
-        if field == "api_key": # Skip the api_key itself
+        if field in _RESERVED_QUERY_PARAMS: # Skip the api_key and write_policy themselves
             continue
         if field in channel_fields:
-            # Attempt to convert to float if it looks like a number
-            try:
-                data_to_insert[field] = float(value)
-            except ValueError:
-                data_to_insert[field] = value # Store as string if not a number
+            # Stored as float if it looks like a number, otherwise as a string
+            data_to_insert[field] = coerce_value(value)
             found_valid_field = True
         else:
             print(f"Warning: Query parameter field '{field}' not defined for channel '{channel_name}'. Ignoring.")
@@ -181,7 +220,7 @@ async def update_channel_data_by_query_params(
     if not found_valid_field:
         raise HTTPException(status_code=400, detail="No valid channel fields provided in query parameters (excluding api_key).")
 
-    await db.data.insert_one(data_to_insert)
+    await _store_data(data_to_insert, write_policy)
     return {"message": "Data written successfully via query parameters", "timestamp": data_to_insert["timestamp"]}
 
 
@@ -190,20 +229,14 @@ async def get_historical_data(
     channel_name: str,
     api_key: str = Query(..., description="API key for authentication"),
     field_name: Optional[str] = Query(None, description="Specific field to retrieve history for (e.g., 'temperature')"),
-    start_time: Optional[datetime.datetime] = Query(None, description="Start timestamp for data history (ISO 8601 format)"),
-    end_time: Optional[datetime.datetime] = Query(None, description="End timestamp for data history (ISO 8601 format)"),
+    start_time: Optional[_dt] = Query(None, description="Start timestamp for data history (ISO 8601 format)"),
+    end_time: Optional[_dt] = Query(None, description="End timestamp for data history (ISO 8601 format)"),
     limit: int = Query(100, description="Maximum number of historical records to retrieve", ge=1, le=1000)
 ):
     """
     Retrieves historical data for a specified channel.
     Can filter by a specific field, time range, and limit the number of results.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     query = {"tank_id": channel_name}
     if start_time or end_time:
         query["timestamp"] = {}
@@ -212,38 +245,51 @@ async def get_historical_data(
         if end_time:
             query["timestamp"]["$lte"] = end_time
 
-    projection = {"_id": 0, "timestamp": 1} # Always include timestamp
+    prefetched = ()
     if field_name:
-        if field_name not in channel["fields"]:
+        # The projection doesn't depend on the channel here, so the first batch is
+        # fetched concurrently with the auth lookup. Both results are gathered before
+        # anything is sent, so a 401/404/400 still goes out without data; on those
+        # paths the prefetched batch is simply discarded.
+        cursor = _history_cursor(query, {"_id": 0, "timestamp": 1, field_name: 1}, limit)
+        first_doc, channel = await asyncio.gather(
+            anext(cursor, None), auth_channel(channel_name, api_key), return_exceptions=True
+        )
+        if isinstance(channel, BaseException) or field_name not in channel.field_set:
+            await cursor.close()
+            if isinstance(channel, BaseException):
+                raise channel
             raise HTTPException(status_code=400, detail=f"Field '{field_name}' is not defined for channel '{channel_name}'")
-        projection[field_name] = 1
+        if isinstance(first_doc, BaseException):
+            raise first_doc
+        if first_doc is not None:
+            prefetched = (first_doc,)
     else:
+        # Without a field name the projection is built from the channel's fields,
+        # so the data query has to wait for the auth lookup
+        channel = await auth_channel(channel_name, api_key)
+        projection = {"_id": 0, "timestamp": 1} # Always include timestamp
         # If no specific field, include all defined fields
-        for field in channel["fields"]:
+        for field in channel.fields:
             projection[field] = 1
+        cursor = _history_cursor(query, projection, limit)
 
-    # Fetch data, sort by timestamp, and apply limit
-    historical_data = await db.data.find(query, projection).sort("timestamp", 1).to_list(limit)
-
-    # Convert datetime objects to ISO format strings for better JSON serialization
-    for entry in historical_data:
-        if isinstance(entry.get("timestamp"), datetime.datetime):
-            entry["timestamp"] = entry["timestamp"].isoformat()
-
-    return historical_data
+    # Documents are streamed out as they arrive from the cursor instead of being
+    # collected into a list first; orjson serializes the timestamps directly.
+    return StreamingResponse(_stream_json_array(cursor, prefetched), media_type="application/json")
 
 
 @router.delete("/{channel_name}", summary="Delete channel and all its data")
 async def delete_channel(channel_name: str, api_key: str = Query(..., description="API key for authentication")):
     """Deletes a channel and all associated historical data."""
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    await auth_channel(channel_name, api_key)
 
-    await db.channels.delete_one({"channel_name": channel_name})
-    await db.data.delete_many({"tank_id": channel_name})
+    # The two deletes are independent, so overlap their round-trips
+    await asyncio.gather(
+        db.channels.delete_one({"channel_name": channel_name}),
+        db.data.delete_many({"tank_id": channel_name})
+    )
+    invalidate(channel_name)
 
     return {"message": f"Channel '{channel_name}' and all related data deleted"}
 
@@ -253,13 +299,9 @@ async def delete_field(channel_name: str, field_name: str, api_key: str = Query(
     Deletes a field from a channel's definition and sets its value to 'N/A'
     in all existing historical data documents for that channel.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    channel = await auth_channel(channel_name, api_key)
 
-    if field_name not in channel["fields"]:
+    if field_name not in channel.field_set:
         raise HTTPException(status_code=404, detail="Field not found in channel")
 
     # Remove field from channel fields array
@@ -273,14 +315,10 @@ async def delete_field(channel_name: str, field_name: str, api_key: str = Query(
         {"tank_id": channel_name},
         {"$set": {field_name: "N/A"}}
     )
+    invalidate(channel_name)
 
     return {"message": f"Field '{field_name}' deleted from channel '{channel_name}' (set to 'N/A' in all data)"}
 
-class ChannelUpdate(BaseModel):
-    """Pydantic model for updating channel fields."""
-    add_fields: Optional[List[str]] = []
-    remove_fields: Optional[List[str]] = []
-
 @router.patch("/{channel_name}", summary="Update channel fields")
 async def update_channel_fields(
     channel_name: str,
@@ -292,32 +330,36 @@ async def update_channel_fields(
     Can add new fields or remove existing ones. Removed fields will have their
     values set to 'N/A' in all historical data documents.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
-    current_fields = set(channel.get("fields", []))
-
-    # Add new fields if any (avoid duplicates)
-    if update.add_fields:
-        current_fields.update(update.add_fields)
-
-    # Remove fields if any
-    if update.remove_fields:
-        current_fields.difference_update(update.remove_fields)
-        # For removed fields, set value to "N/A" in all data docs
-        for field in update.remove_fields:
-            await db.data.update_many(
-                {"tank_id": channel_name},
-                {"$set": {field: "N/A"}}
-            )
-
-    # Update the channel document with new fields list
-    await db.channels.update_one(
+    await auth_channel(channel_name, api_key)
+
+    add_fields = update.add_fields or []
+    remove_fields = update.remove_fields or []
+
+    # Let MongoDB apply the add/remove atomically so concurrent PATCHes don't clobber
+    # each other, and hand back the resulting list. $addToSet and $pullAll can't
+    # target the same path in one update, so this uses the pipeline form with the
+    # equivalent set operators. The user-supplied names are wrapped in $literal so
+    # one starting with '$' isn't evaluated as a field path.
+    updated_channel = await db.channels.find_one_and_update(
         {"channel_name": channel_name},
-        {"$set": {"fields": list(current_fields)}}
+        [{"$set": {"fields": {"$setDifference": [
+            {"$setUnion": [{"$ifNull": ["$fields", []]}, {"$literal": add_fields}]},
+            {"$literal": remove_fields}
+        ]}}}],
+        projection={"_id": 0, "fields": 1},
+        return_document=ReturnDocument.AFTER
     )
+    invalidate(channel_name)
+    if updated_channel is None: # Deleted since it was authorized
+        raise HTTPException(status_code=404, detail="Channel not found")
+
+    # For removed fields, set value to "N/A" in all data docs with a single update.
+    # It only runs once the channel update succeeded, so a failure there leaves the
+    # data untouched.
+    if remove_fields:
+        await db.data.update_many(
+            {"tank_id": channel_name},
+            {"$set": {field: "N/A" for field in remove_fields}}
+        )
 
-    return {"message": "Channel fields updated", "fields": list(current_fields)}
\ No newline at end of file
+    return {"message": "Channel fields updated", "fields": updated_channel["fields"]}
\ No newline at end of file
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from app.database import db
-import datetime
+from app.utils import auth_channel
 
 router = APIRouter(tags=["data"])
 
@@ -10,28 +11,22 @@ async def get_latest_data(channel_name: str, api_key: str = Query(..., descripti
     Retrieves the most recent data entry for a specific channel.
     This fetches the single latest record from the historical data.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    await auth_channel(channel_name, api_key)
 
     # Fetch the latest data entry based on timestamp
-    # We sort by timestamp in descending order and take the first one
-    data = await db.data.find({"tank_id": channel_name}).sort("timestamp", -1).to_list(length=1)
+    # find_one with a descending sort lets the server stop at the first index entry
+    latest_entry = await db.data.find_one(
+        {"tank_id": channel_name},
+        projection={"_id": 0},
+        sort=[("timestamp", -1)]
+    )
 
-    if not data:
+    if latest_entry is None:
         raise HTTPException(status_code=404, detail="No data found for this channel.")
 
-    latest_entry = data[0]
-    # Convert ObjectId to str for JSON serialization (if it exists)
-    if "_id" in latest_entry:
-        latest_entry["_id"] = str(latest_entry["_id"])
-    # Convert datetime object to ISO format string for consistency
-    if isinstance(latest_entry.get("timestamp"), datetime.datetime):
-        latest_entry["timestamp"] = latest_entry["timestamp"].isoformat()
-
-    return latest_entry
+    # Returned as a response directly so the document goes straight to orjson,
+    # skipping FastAPI's jsonable_encoder pass over it
+    return ORJSONResponse(latest_entry)
 
 @router.get("/{channel_name}/latest/{field_name}", summary="Get specific field value from latest data")
 async def get_field_value(
@@ -42,27 +37,27 @@ async def get_field_value(
     """
     Retrieves the value of a specific field from the most recent data entry for a channel.
     """
-    channel = await db.channels.find_one({"channel_name": channel_name})
-    if not channel:
-        raise HTTPException(status_code=404, detail="Channel not found")
-    if api_key != channel["api_key"]:
-        raise HTTPException(status_code=401, detail="Invalid API key")
+    channel = await auth_channel(channel_name, api_key)
 
-    if field_name not in channel["fields"]:
+    if field_name not in channel.field_set:
         raise HTTPException(status_code=400, detail=f"Field '{field_name}' is not defined for channel '{channel_name}'")
 
-    # Fetch the latest data entry
-    data = await db.data.find({"tank_id": channel_name}).sort("timestamp", -1).to_list(length=1)
+    # Fetch the latest data entry, returning only the requested field and its timestamp
+    latest_entry = await db.data.find_one(
+        {"tank_id": channel_name},
+        projection={"_id": 0, field_name: 1, "timestamp": 1},
+        sort=[("timestamp", -1)]
+    )
 
-    if not data or field_name not in data[0]:
+    if latest_entry is None or field_name not in latest_entry:
         raise HTTPException(status_code=404, detail=f"Field '{field_name}' data not found for this channel.")
 
-    return {
+    return ORJSONResponse({
         "channel_name": channel_name,
         "field": field_name,
-        "value": data[0][field_name],
-        "timestamp": data[0]["timestamp"].isoformat() if isinstance(data[0].get("timestamp"), datetime.datetime) else data[0].get("timestamp")
-    }
+        "value": latest_entry[field_name],
+        "timestamp": latest_entry.get("timestamp")
+    })
 
 # Removed:
 # @router.post("/{tank_id}", status_code=201) - Replaced by POST /channels/{channel_name}/data in channels.py
@@ -1,6 +1,169 @@
-import random
-import string
+import functools
+import secrets
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, NamedTuple, Optional, Tuple, Union
 
-def generate_api_key(length: int = 12) -> str:
-    characters = string.ascii_uppercase + string.digits  # A-Z, 0-9
-    return ''.join(random.choices(characters, k=length))
+from fastapi import HTTPException
+from fastnumbers import INPUT, try_float
+
+from app.database import db
+
+# msgspec is optional; without it CoAP payloads fall back to an untyped JSON parse
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Only what the routes need to authorize a request and validate fields
+CHANNEL_PROJECTION = {"_id": 0, "api_key": 1, "fields": 1}
+
+class CachedChannel(NamedTuple):
+    """What the routes need from a channel, precomputed once per cache fill."""
+    api_key: str
+    fields: Tuple[str, ...]
+    field_set: FrozenSet[str]
+    coerce: Callable[[Dict[str, Any]], Dict[str, Any]]
+    decode: Optional[Callable[[bytes], Dict[str, Any]]]
+
+# Channels are small and rarely change, so authorized lookups are kept in a bounded
+# LRU with a TTL. Routes that mutate a channel call invalidate() on it; the TTL bounds
+# staleness for changes made by other workers/processes.
+_CACHE_TTL = 60  # seconds
+_CACHE_MAXSIZE = 10_000
+_CHANNEL_CACHE: "OrderedDict[str, Tuple[float, CachedChannel]]" = OrderedDict()
+
+def generate_api_key() -> str:
+    # 9 random bytes encode to exactly 12 URL-safe characters
+    return secrets.token_urlsafe(9)
+
+def coerce_value(value: Any) -> Any:
+    """
+    Converts a value to float if it is numeric or a numeric string, otherwise
+    returns it unchanged. fastnumbers does the check in C, so non-numeric values
+    don't pay for a raised ValueError.
+    """
+    return try_float(value, on_fail=INPUT, on_type_error=INPUT, allow_underscores=True)
+
+_MISSING = object()
+
+@functools.lru_cache(maxsize=1024)
+def make_coercer(fields: Tuple[str, ...]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Builds a function that picks a channel's fields out of a payload and coerces
+    their values, specialized once per distinct field layout. It only walks the
+    known fields, so unknown payload keys cost nothing.
+    """
+    def coerce(payload: Dict[str, Any]) -> Dict[str, Any]:
+        values = {}
+        for name in fields:
+            value = payload.get(name, _MISSING)
+            if value is not _MISSING:
+                values[name] = value if type(value) is float else coerce_value(value)
+        return values
+    return coerce
+
+@functools.lru_cache(maxsize=1024)
+def make_decoder(fields: Tuple[str, ...]) -> Optional[Callable[[bytes], Dict[str, Any]]]:
+    """
+    Builds a msgspec JSON decoder for a channel's payloads from a Struct with one
+    optional scalar attribute per field. It decodes and validates in one pass and
+    returns only the fields that were present; unknown keys are skipped, whatever
+    their value. Raises msgspec.ValidationError if a known field holds an object
+    or array. Returns None when msgspec isn't installed.
+    """
+    if msgspec is None:
+        return None
+    # Field names needn't be Python identifiers, so the attributes get positional
+    # names and are renamed to the real field names on the wire
+    attrs = tuple(f"f{i}" for i in range(len(fields)))
+    payload_type = msgspec.defstruct(
+        "ChannelPayload",
+        [(attr, Union[float, str, bool, None, msgspec.UnsetType], msgspec.UNSET) for attr in attrs],
+        rename=dict(zip(attrs, fields))
+    )
+    decoder = msgspec.json.Decoder(payload_type)
+    pairs = tuple(zip(attrs, fields))
+    unset = msgspec.UNSET
+
+    def decode(payload: bytes) -> Dict[str, Any]:
+        obj = decoder.decode(payload)
+        values = {}
+        for attr, name in pairs:
+            value = getattr(obj, attr)
+            if value is not unset:
+                values[name] = value
+        return values
+    return decode
+
+def invalidate(channel_name: str) -> None:
+    """Drops a channel from the lookup cache after it was changed or deleted."""
+    _CHANNEL_CACHE.pop(channel_name, None)
+
+def _cache_channel(channel_name: str, doc: Dict[str, Any]) -> CachedChannel:
+    # The field set is built once per cache fill rather than on every write
+    fields = tuple(dict.fromkeys(doc.get("fields", [])))
+    channel = CachedChannel(
+        doc["api_key"], fields, frozenset(fields), make_coercer(fields), make_decoder(fields)
+    )
+    _CHANNEL_CACHE[channel_name] = (time.monotonic(), channel)
+    _CHANNEL_CACHE.move_to_end(channel_name)
+    if len(_CHANNEL_CACHE) > _CACHE_MAXSIZE:
+        _CHANNEL_CACHE.popitem(last=False)
+    return channel
+
+def _cached_channel(channel_name: str) -> Optional[CachedChannel]:
+    cached = _CHANNEL_CACHE.get(channel_name)
+    if cached is not None and time.monotonic() - cached[0] < _CACHE_TTL:
+        _CHANNEL_CACHE.move_to_end(channel_name)
+        return cached[1]
+    return None
+
+async def lookup_channel(channel_name: str, api_key: str) -> Optional[CachedChannel]:
+    """
+    Returns the channel if it exists and the API key matches, otherwise None.
+    Fetches with a single query on (channel_name, api_key) and serves repeat
+    lookups from the in-process cache.
+    """
+    channel = _cached_channel(channel_name)
+    if channel is not None and channel.api_key == api_key:
+        return channel
+
+    doc = await db.channels.find_one(
+        {"channel_name": channel_name, "api_key": api_key},
+        CHANNEL_PROJECTION
+    )
+    if doc is None:
+        return None
+    return _cache_channel(channel_name, doc)
+
+async def lookup_channel_by_name(channel_name: str) -> Optional[CachedChannel]:
+    """
+    Returns the channel or None, without an API key check. Only for trusted
+    ingest paths such as the MQTT broker subscription.
+    """
+    channel = _cached_channel(channel_name)
+    if channel is not None:
+        return channel
+
+    doc = await db.channels.find_one({"channel_name": channel_name}, CHANNEL_PROJECTION)
+    if doc is None:
+        return None
+    return _cache_channel(channel_name, doc)
+
+async def channel_exists(channel_name: str) -> bool:
+    """Tells a wrong API key apart from a missing channel after a failed lookup."""
+    return bool(await db.channels.count_documents({"channel_name": channel_name}, limit=1))
+
+async def auth_channel(channel_name: str, api_key: str) -> CachedChannel:
+    """
+    Looks up a channel for an HTTP route.
+    Raises 404 if the channel does not exist and 401 if the API key does not match.
+    """
+    channel = await lookup_channel(channel_name, api_key)
+    if channel is None:
+        # Only the failure path pays for a second lookup to pick the right status code
+        if await channel_exists(channel_name):
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        raise HTTPException(status_code=404, detail="Channel not found")
+    return channel
@@ -1,16 +1,88 @@
 # coap_server.py
 import asyncio
 import json
+import os
 import datetime
+from urllib.parse import parse_qsl
 from aiocoap import Context, Message, PUT, GET, Code
 from aiocoap.resource import Resource, Site # Corrected import for Resource and Site
 from aiocoap.numbers import ContentFormat
 
+# msgspec and orjson are optional here; the stdlib json module works as a slower fallback
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# With msgspec, PUT bodies are decoded and validated by the channel's own decoder
+# (CachedChannel.decode). Without it they are parsed untyped straight from the bytes
+# and the channel's coercer picks out its fields.
+if orjson is not None:
+    _loads = orjson.loads
+    _DECODE_ERRORS = (orjson.JSONDecodeError,)
+else:
+    _loads = json.loads
+    _DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+if msgspec is not None:
+    _VALIDATION_ERRORS = (msgspec.ValidationError,)
+    _DECODE_ERRORS += (msgspec.DecodeError,) # checked after _VALIDATION_ERRORS, its subclass
+else:
+    _VALIDATION_ERRORS = ()
+
+# Responses prefer orjson, which can mark the stored (naive, UTC) timestamps with a 'Z'
+if orjson is not None:
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC)
+elif msgspec is not None:
+    _dumps = msgspec.json.Encoder().encode
+else:
+    def _json_default(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, default=_json_default).encode('utf-8')
+
 # Assuming your db connection and models are accessible
 # You might need to adjust the import path based on your project structure
 # The 'db' object is an instance of your Database class, which will be connected
 # by FastAPI's startup event in main.py
 from app.database import db
+from app.utils import channel_exists, lookup_channel
+
+_UTC = datetime.timezone.utc # Bound once for the per-request timestamps
+
+# Successful PUT response, split around its only variable part (the ISO timestamp)
+_OK_PREFIX = b'{"message":"Data written successfully via CoAP","timestamp":"'
+_OK_SUFFIX = b'"}'
+
+# Payloads of the common error responses. Handlers build a fresh Message around them,
+# which is cheaper than copying a prebuilt one (Message.copy() deep-copies the options).
+_ERR_NO_API_KEY = b"API key is required in query parameters (e.g., ?api_key=YOUR_KEY)."
+_ERR_INVALID_API_KEY = b"Invalid API key."
+_ERR_CHANNEL_NOT_FOUND = b"Channel not found."
+_ERR_EMPTY_PAYLOAD = b"Empty payload."
+_ERR_INVALID_JSON = b"Invalid JSON payload."
+_ERR_NOT_AN_OBJECT = b"Payload must be a JSON object."
+_ERR_NO_VALID_FIELDS = b"No valid channel fields provided in data that match channel configuration."
+
+# The GET resources issue the channel lookup and the latest-data read together instead of
+# one after the other; authorization is still checked before any data is returned.
+# Set COAP_PARALLEL_READ=0 to go back to sequential reads for comparison.
+PARALLEL_READ = os.getenv("COAP_PARALLEL_READ", "1") != "0"
+
+def _parse_query(uri_query):
+    """Turns the Uri-Query options (e.g. ('api_key=XYZ',)) into a dict."""
+    return dict(parse_qsl('&'.join(uri_query), keep_blank_values=True))
+
+def _find_latest(collection, channel_name, projection):
+    """Newest data document for a channel; a single findOne walks the (tank_id, timestamp) index."""
+    return collection.find_one({"tank_id": channel_name}, projection=projection, sort=[("timestamp", -1)])
 
 class ChannelDataResource(Resource):
     """
@@ -31,65 +103,56 @@ class ChannelDataResource(Resource):
         channel_name = request.opt.uri_path[1]
 
         # 1. Extract API Key (e.g., from query parameter)
-        query_params = {}
-        for param in request.opt.uri_query:
-            if '=' in param:
-                k, v = param.split('=', 1)
-                query_params[k] = v
-            else:
-                query_params[param] = "" # Handle params without values
-        api_key = query_params.get("api_key")
+        api_key = _parse_query(request.opt.uri_query).get("api_key")
 
         if not api_key:
-            return Message(code=Code.BAD_REQUEST, payload=b"API key is required in query parameters (e.g., ?api_key=YOUR_KEY).")
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_NO_API_KEY)
 
         # 2. Authenticate and Validate Channel
-        channel = await self.db.channels.find_one({"channel_name": channel_name})
-        if not channel:
-            return Message(code=Code.NOT_FOUND, payload=b"Channel not found.")
-        if api_key != channel["api_key"]:
-            return Message(code=Code.UNAUTHORIZED, payload=b"Invalid API key.")
+        # Served from the shared channel cache, so repeat requests skip MongoDB
+        channel = await lookup_channel(channel_name, api_key)
+        if channel is None:
+            if await channel_exists(channel_name):
+                return Message(code=Code.UNAUTHORIZED, payload=_ERR_INVALID_API_KEY)
+            return Message(code=Code.NOT_FOUND, payload=_ERR_CHANNEL_NOT_FOUND)
 
         # 3. Parse Payload
         if not request.payload:
-            return Message(code=Code.BAD_REQUEST, payload=b"Empty payload.")
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_EMPTY_PAYLOAD)
 
         try:
-            payload_str = request.payload.decode('utf-8')
-            data_payload = json.loads(payload_str)
-        except json.JSONDecodeError:
-            return Message(code=Code.BAD_REQUEST, payload=b"Invalid JSON payload.")
-        except UnicodeDecodeError:
-            return Message(code=Code.BAD_REQUEST, payload=b"Invalid payload encoding.")
-
-        # 4. Prepare and Insert Data (similar to FastAPI's write_data logic)
-        data_doc = {
-            "tank_id": channel_name,
-            "timestamp": datetime.datetime.now(datetime.timezone.utc)
-        }
-        channel_fields = set(channel.get("fields", []))
-        valid_field_found = False
-
-        for field, value in data_payload.items():
-            if field in channel_fields:
-                try:
-                    # Attempt to convert to float if possible, otherwise keep as is
-                    data_doc[field] = float(value)
-                except (ValueError, TypeError):
-                    data_doc[field] = value
-                valid_field_found = True
+            if channel.decode is not None:
+                # Only the channel's fields, each checked to be a JSON scalar
+                data_payload = channel.decode(request.payload)
             else:
+                data_payload = _loads(request.payload)
+        except _VALIDATION_ERRORS as e:
+            return Message(code=Code.BAD_REQUEST, payload=f"Invalid payload: {e}".encode('utf-8'))
+        except _DECODE_ERRORS:
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_INVALID_JSON)
+
+        if not isinstance(data_payload, dict):
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_NOT_AN_OBJECT)
+
+        # 4. Prepare and Insert Data (similar to FastAPI's write_data logic).
+        # The channel's precompiled coercer keeps only its fields and converts numeric values.
+        values = channel.coerce(data_payload)
+        if not values:
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_NO_VALID_FIELDS)
+        if len(values) < len(data_payload):
+            for field in data_payload.keys() - channel.field_set:
                 print(f"Warning: Field '{field}' from CoAP not defined for channel '{channel_name}'. Ignoring.")
 
-        if not valid_field_found:
-            return Message(code=Code.BAD_REQUEST, payload=b"No valid channel fields provided in data that match channel configuration.")
+        data_doc = {
+            "tank_id": channel_name,
+            "timestamp": datetime.datetime.now(_UTC),
+            **values
+        }
 
-        await self.db.data.insert_one(data_doc)
+        await self.db.data_fast.insert_one(data_doc) # fire-and-forget telemetry write
 
-        response_payload = json.dumps({
-            "message": "Data written successfully via CoAP",
-            "timestamp": data_doc["timestamp"].isoformat()
-        }).encode('utf-8')
+        # Only the timestamp varies, so the JSON is assembled from constant bytes
+        response_payload = _OK_PREFIX + data_doc["timestamp"].isoformat().encode('ascii') + _OK_SUFFIX
         return Message(code=Code.CREATED, payload=response_payload, content_format=ContentFormat.JSON)
 
 
@@ -109,37 +172,35 @@ class ChannelLatestDataResource(Resource):
             return Message(code=Code.BAD_REQUEST, payload=b"Invalid URI path for latest data get.")
         channel_name = request.opt.uri_path[1]
 
-        query_params = {}
-        for param in request.opt.uri_query:
-            if '=' in param:
-                k, v = param.split('=', 1)
-                query_params[k] = v
-            else:
-                query_params[param] = ""
-        api_key = query_params.get("api_key")
+        api_key = _parse_query(request.opt.uri_query).get("api_key")
 
         if not api_key:
-            return Message(code=Code.BAD_REQUEST, payload=b"API key is required.")
-
-        channel = await self.db.channels.find_one({"channel_name": channel_name})
-        if not channel:
-            return Message(code=Code.NOT_FOUND, payload=b"Channel not found.")
-        if api_key != channel["api_key"]:
-            return Message(code=Code.UNAUTHORIZED, payload=b"Invalid API key.")
-
-        data = await self.db.data.find({"tank_id": channel_name}).sort("timestamp", -1).to_list(length=1)
-
-        if not data:
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_NO_API_KEY)
+
+        # _id is projected out on the server, so the document serializes as-is
+        projection = {"_id": 0}
+        if PARALLEL_READ:
+            # On a channel cache miss both reads share one round-trip time; the data
+            # read is simply discarded if authorization fails below
+            channel, latest_entry = await asyncio.gather(
+                lookup_channel(channel_name, api_key),
+                _find_latest(self.db.data, channel_name, projection)
+            )
+        else:
+            channel = await lookup_channel(channel_name, api_key)
+
+        if channel is None:
+            if await channel_exists(channel_name):
+                return Message(code=Code.UNAUTHORIZED, payload=_ERR_INVALID_API_KEY)
+            return Message(code=Code.NOT_FOUND, payload=_ERR_CHANNEL_NOT_FOUND)
+
+        if not PARALLEL_READ:
+            latest_entry = await _find_latest(self.db.data, channel_name, projection)
+
+        if latest_entry is None:
             return Message(code=Code.NOT_FOUND, payload=b"No data found for this channel.")
 
-        latest_entry = data[0]
-        # Clean up _id for JSON serialization and format timestamp
-        if "_id" in latest_entry:
-            del latest_entry["_id"]
-        if isinstance(latest_entry.get("timestamp"), datetime.datetime):
-            latest_entry["timestamp"] = latest_entry["timestamp"].isoformat()
-
-        response_payload = json.dumps(latest_entry).encode('utf-8')
+        response_payload = _dumps(latest_entry)
         return Message(code=Code.CONTENT, payload=response_payload, content_format=ContentFormat.JSON)
 
 class ChannelLatestFieldResource(Resource):
@@ -159,39 +220,43 @@ class ChannelLatestFieldResource(Resource):
         channel_name = request.opt.uri_path[1]
         field_name = request.opt.uri_path[2]
 
-        query_params = {}
-        for param in request.opt.uri_query:
-            if '=' in param:
-                k, v = param.split('=', 1)
-                query_params[k] = v
-            else:
-                query_params[param] = ""
-        api_key = query_params.get("api_key")
+        api_key = _parse_query(request.opt.uri_query).get("api_key")
 
         if not api_key:
-            return Message(code=Code.BAD_REQUEST, payload=b"API key is required.")
-
-        channel = await self.db.channels.find_one({"channel_name": channel_name})
-        if not channel:
-            return Message(code=Code.NOT_FOUND, payload=b"Channel not found.")
-        if api_key != channel["api_key"]:
-            return Message(code=Code.UNAUTHORIZED, payload=b"Invalid API key.")
-
-        if field_name not in channel["fields"]:
+            return Message(code=Code.BAD_REQUEST, payload=_ERR_NO_API_KEY)
+
+        # Only the requested field and its timestamp come back over the wire. The field
+        # comes from the path, so the projection is known before the channel is.
+        projection = {field_name: 1, "timestamp": 1, "_id": 0}
+        if PARALLEL_READ:
+            channel, latest_entry = await asyncio.gather(
+                lookup_channel(channel_name, api_key),
+                _find_latest(self.db.data, channel_name, projection)
+            )
+        else:
+            channel = await lookup_channel(channel_name, api_key)
+
+        if channel is None:
+            if await channel_exists(channel_name):
+                return Message(code=Code.UNAUTHORIZED, payload=_ERR_INVALID_API_KEY)
+            return Message(code=Code.NOT_FOUND, payload=_ERR_CHANNEL_NOT_FOUND)
+
+        if field_name not in channel.field_set:
             return Message(code=Code.BAD_REQUEST, payload=f"Field '{field_name}' is not defined for channel '{channel_name}'.".encode('utf-8'))
 
-        data = await self.db.data.find({"tank_id": channel_name}).sort("timestamp", -1).to_list(length=1)
+        if not PARALLEL_READ:
+            latest_entry = await _find_latest(self.db.data, channel_name, projection)
 
-        if not data or field_name not in data[0]:
+        if latest_entry is None or field_name not in latest_entry:
             return Message(code=Code.NOT_FOUND, payload=f"Field '{field_name}' data not found for this channel.".encode('utf-8'))
 
         response_data = {
             "channel_name": channel_name,
             "field": field_name,
-            "value": data[0][field_name],
-            "timestamp": data[0]["timestamp"].isoformat() if isinstance(data[0].get("timestamp"), datetime.datetime) else data[0].get("timestamp")
+            "value": latest_entry[field_name],
+            "timestamp": latest_entry.get("timestamp")
         }
-        response_payload = json.dumps(response_data).encode('utf-8')
+        response_payload = _dumps(response_data)
         return Message(code=Code.CONTENT, payload=response_payload, content_format=ContentFormat.JSON)
 
 async def coap_main():
@@ -246,8 +311,14 @@ if __name__ == "__main__":
             await global_db.close_mongodb_connection()
 
 
+    # uvloop is a faster drop-in event loop; it isn't available on Windows
+    try:
+        from uvloop import run as _run
+    except ImportError:
+        _run = asyncio.run
+
     try:
-        asyncio.run(run_test_server())
+        _run(run_test_server())
     except KeyboardInterrupt:
         print("CoAP server stopped by user.")
     except Exception as e:
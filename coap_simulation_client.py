@@ -16,11 +16,11 @@ COAP_SERVER_HOST = "localhost"
 COAP_SERVER_PORT = 5684
 # ----------------------------------------
 
-async def send_coap_post(channel_name: str, api_key: str, data_payload: dict):
-    """Sends a CoAP POST request to the server with data."""
-    protocol = await aiocoap.Context.create_client_context()
-    
-    # Construct the URI for data POST, including API key as a query parameter
+async def send_coap_post(protocol: aiocoap.Context, channel_name: str, api_key: str, data_payload: dict):
+    """Sends a CoAP POST request to the server with data, over the shared client context."""
+    # Construct the URI for data POST, including API key as a query parameter.
+    # Passing uri= also sets the request's remote endpoint, which Uri-Host/Uri-Port
+    # options alone don't.
     uri = f"coap://{COAP_SERVER_HOST}:{COAP_SERVER_PORT}/data/{channel_name}?api_key={api_key}"
     payload_bytes = json.dumps(data_payload).encode('utf-8')
 
@@ -40,23 +40,19 @@ async def send_coap_post(channel_name: str, api_key: str, data_payload: dict):
         logger.info(f"CoAP POST Response Payload: {response.payload.decode('utf-8')}")
     except Exception as e:
         logger.error(f"Failed to send CoAP POST request: {e}")
-    finally:
-        await protocol.shutdown()
 
-async def send_coap_get(channel_name: str, api_key: str, query_params: dict = None):
+async def send_coap_get(protocol: aiocoap.Context, channel_name: str, api_key: str, query_params: dict = None):
     """
     Sends a CoAP GET request to the server, typically for status updates or requests.
     Query parameters are included in the URL.
     """
-    protocol = await aiocoap.Context.create_client_context()
-    
     # Combine API key with any other query parameters provided
     full_query_params = {"api_key": api_key}
     if query_params:
         full_query_params.update(query_params)
-        
+
     encoded_params = urlencode(full_query_params)
-    
+
     # Construct the URI for GET request, including API key and other params
     uri = f"coap://{COAP_SERVER_HOST}:{COAP_SERVER_PORT}/update/{channel_name}?{encoded_params}"
 
@@ -73,8 +69,6 @@ async def send_coap_get(channel_name: str, api_key: str, query_params: dict = No
         logger.info(f"CoAP GET Response Payload: {response.payload.decode('utf-8')}")
     except Exception as e:
         logger.error(f"Failed to send CoAP GET request: {e}")
-    finally:
-        await protocol.shutdown()
 
 async def main():
     # --- IMPORTANT: Configure your channel details here for local testing ---
@@ -98,22 +92,27 @@ async def main():
     logger.info("Waiting 5 seconds before sending requests...")
     await asyncio.sleep(5) 
 
-    # --- Simulate sending POST data ---
-    logger.info("\n--- Sending first POST request (level, temperature, humidity) ---")
-    data_payload_1 = {"level": 75.2, "temperature": 22.5, "humidity": 58.0}
-    await send_coap_post(YOUR_CHANNEL_NAME, YOUR_API_KEY, data_payload_1)
-    await asyncio.sleep(3) # Short delay
-
-    logger.info("\n--- Sending second POST request (just level, simulating update) ---")
-    data_payload_2 = {"level": 76.8}
-    await send_coap_post(YOUR_CHANNEL_NAME, YOUR_API_KEY, data_payload_2)
-    await asyncio.sleep(3) # Short delay
-
-    # --- Simulate sending GET request (for status/update) ---
-    logger.info("\n--- Sending GET request (client status update) ---")
-    get_params = {"status": "online", "battery_level": "80%"}
-    await send_coap_get(YOUR_CHANNEL_NAME, YOUR_API_KEY, get_params)
-    await asyncio.sleep(3)
+    # One client context (UDP socket + transports) is created up front and reused for every request
+    protocol = await aiocoap.Context.create_client_context()
+    try:
+        # --- Simulate sending POST data ---
+        logger.info("\n--- Sending first POST request (level, temperature, humidity) ---")
+        data_payload_1 = {"level": 75.2, "temperature": 22.5, "humidity": 58.0}
+        await send_coap_post(protocol, YOUR_CHANNEL_NAME, YOUR_API_KEY, data_payload_1)
+        await asyncio.sleep(3) # Short delay
+
+        logger.info("\n--- Sending second POST request (just level, simulating update) ---")
+        data_payload_2 = {"level": 76.8}
+        await send_coap_post(protocol, YOUR_CHANNEL_NAME, YOUR_API_KEY, data_payload_2)
+        await asyncio.sleep(3) # Short delay
+
+        # --- Simulate sending GET request (for status/update) ---
+        logger.info("\n--- Sending GET request (client status update) ---")
+        get_params = {"status": "online", "battery_level": "80%"}
+        await send_coap_get(protocol, YOUR_CHANNEL_NAME, YOUR_API_KEY, get_params)
+        await asyncio.sleep(3)
+    finally:
+        await protocol.shutdown()
 
     logger.info("\nCoAP client simulation completed for this run.")
 
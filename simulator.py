@@ -1,8 +1,8 @@
-import requests
-import random
-import time
+import asyncio
+import aiohttp
+import numpy as np
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime
-from apscheduler.schedulers.blocking import BlockingScheduler
 import os # Import os module to get environment variables
 
 # --- Configuration ---
@@ -10,9 +10,10 @@ import os # Import os module to get environment variables
 # If you deploy it elsewhere, update this base URL.
 FASTAPI_BASE_URL = os.getenv("FASTAPI_BASE_URL", "http://localhost:8000/api")
 
-# Channel details for 'tank2'
-CHANNEL_NAME = "tank2"
-API_KEY = "MEV7H0D0NNKK"
+# Simulated tanks as (channel_name, api_key) pairs; all of them are sent concurrently
+TANKS = [
+    ("tank2", "MEV7H0D0NNKK"),
+]
 
 # Standard values for each field
 # These are your "baseline" values
@@ -30,76 +31,83 @@ DEVIATION_RANGE = 10.0
 # Interval for sending data (in minutes)
 SEND_INTERVAL_MINUTES = 1
 
-def generate_random_value(field_name):
+# Hard limits for fields that can't leave a physical range
+FIELD_LIMITS = {
+    "ph": (0.0, 14.0),          # pH typically ranges from 0 to 14
+    "level": (0.0, np.inf),     # Level should generally not go below zero
+}
+
+# Per-field sampling bounds as arrays (one column per field), built once at import so
+# each tick draws every tank's readings in a single vectorized call
+FIELD_NAMES = list(STANDARD_VALUES.keys())
+_means = np.array([STANDARD_VALUES[f] for f in FIELD_NAMES])
+_lows = np.maximum(_means - DEVIATION_RANGE, [FIELD_LIMITS.get(f, (-np.inf, np.inf))[0] for f in FIELD_NAMES])
+_highs = np.minimum(_means + DEVIATION_RANGE, [FIELD_LIMITS.get(f, (-np.inf, np.inf))[1] for f in FIELD_NAMES])
+_rng = np.random.default_rng()
+
+def generate_random_values(n_tanks):
     """
-    Generates a random value for a given field within +/- DEVIATION_RANGE
-    from its standard value. Applies specific constraints for 'ph' and 'level'.
+    Generates one reading per field for each of n_tanks tanks, uniformly within
+    +/- DEVIATION_RANGE of the standard value and inside FIELD_LIMITS, rounded to
+    2 decimal places. Returns one {field: value} dict per tank.
     """
-    standard_val = STANDARD_VALUES.get(field_name)
-    if standard_val is None:
-        print(f"Warning: No standard value defined for field '{field_name}'. Skipping.")
-        return None
-    
-    min_val = standard_val - DEVIATION_RANGE
-    max_val = standard_val + DEVIATION_RANGE
-    
-    # Apply specific constraints for certain fields
-    if field_name == "ph":
-        # pH typically ranges from 0 to 14
-        return round(random.uniform(max(0.0, min_val), min(14.0, max_val)), 2)
-    elif field_name == "level":
-        # Level should generally not go below zero
-        return round(random.uniform(max(0.0, min_val), max_val), 2)
-    else:
-        # For other fields, generate a float and round to 2 decimal places
-        return round(random.uniform(min_val, max_val), 2)
-
-def send_data_to_channel():
+    values = _rng.uniform(_lows, _highs, size=(n_tanks, len(FIELD_NAMES))).round(2)
+    return [dict(zip(FIELD_NAMES, row)) for row in values.tolist()]
+
+async def send_data_to_channel(session: aiohttp.ClientSession, channel_name: str, api_key: str, values: dict):
     """
-    Generates data for all defined fields, constructs the URL with query parameters,
-    and sends an HTTP GET request to the FastAPI server.
+    Sends one set of field values to the FastAPI server's update endpoint as
+    query parameters, over the shared keep-alive session.
     """
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{current_time}] Generating and sending data for channel '{CHANNEL_NAME}'...")
-    
-    data_to_send = {}
-    for field in STANDARD_VALUES.keys():
-        value = generate_random_value(field)
-        if value is not None:
-            data_to_send[field] = value
-    
-    # Construct the query parameters for the GET request
-    query_params = f"api_key={API_KEY}"
-    for field, value in data_to_send.items():
-        # URL-encode field names and values to handle spaces or special characters
-        query_params += f"&{requests.utils.quote(field)}={requests.utils.quote(str(value))}"
-            
-    # Construct the full URL for the update endpoint
-    url = f"{FASTAPI_BASE_URL}/channels/{requests.utils.quote(CHANNEL_NAME)}/update?{query_params}"
-    
+    print(f"[{current_time}] Sending data for channel '{channel_name}'...")
+
+    data_to_send = {"api_key": api_key, **values}
+
+    # aiohttp URL-encodes the channel path and query parameters itself
+    url = f"{FASTAPI_BASE_URL}/channels/{channel_name}/update"
+
+    try:
+        async with session.get(url, params=data_to_send) as response:
+            if response.status >= 400:
+                print(f"Error sending data for '{channel_name}': HTTP {response.status}")
+                print(f"Server response content: {await response.text()}")
+                return
+            print(f"Data sent successfully for '{channel_name}'! Response: {await response.json()}")
+    except aiohttp.ClientError as e:
+        print(f"Error sending data for '{channel_name}': {e}")
+
+async def send_all_tanks(session: aiohttp.ClientSession):
+    """Draws one reading per tank and sends them all concurrently."""
+    readings = generate_random_values(len(TANKS))
+    await asyncio.gather(*(
+        send_data_to_channel(session, name, key, values)
+        for (name, key), values in zip(TANKS, readings)
+    ))
+
+async def main():
+    # One session (and its connection pool) is shared by every tank and every tick
+    async with aiohttp.ClientSession() as session:
+        # --- Scheduler Setup ---
+        # AsyncIOScheduler runs the job on this event loop instead of blocking a thread
+        scheduler = AsyncIOScheduler()
+        scheduler.add_job(
+            send_all_tanks, 'interval', minutes=SEND_INTERVAL_MINUTES,
+            args=[session], next_run_time=datetime.now() # first send right away
+        )
+        scheduler.start()
+        try:
+            await asyncio.Event().wait() # run until cancelled (Ctrl+C)
+        finally:
+            scheduler.shutdown(wait=False)
+
+if __name__ == "__main__":
+    print(f"IoT Data Simulator started for {len(TANKS)} channel(s): {', '.join(name for name, _ in TANKS)}.")
+    print(f"Data will be sent every {SEND_INTERVAL_MINUTES} minutes to {FASTAPI_BASE_URL}.")
+    print("Press Ctrl+C to stop the simulator.")
+
     try:
-        # Send the GET request
-        response = requests.get(url)
-        response.raise_for_status() # Raise an HTTPError for bad responses (4xx or 5xx)
-        print(f"Data sent successfully! Response: {response.json()}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending data: {e}")
-        if hasattr(response, 'text'): # Check if response object exists and has text attribute
-            print(f"Server response content: {response.text}")
-
-# --- Scheduler Setup ---
-scheduler = BlockingScheduler()
-
-# Schedule the 'send_data_to_channel' function to run every 10 minutes
-scheduler.add_job(send_data_to_channel, 'interval', minutes=SEND_INTERVAL_MINUTES)
-
-print(f"IoT Data Simulator started for channel '{CHANNEL_NAME}'.")
-print(f"Data will be sent every {SEND_INTERVAL_MINUTES} minutes to {FASTAPI_BASE_URL}.")
-print("Press Ctrl+C to stop the simulator.")
-
-try:
-    # Start the scheduler. This will block the main thread.
-    scheduler.start()
-except (KeyboardInterrupt, SystemExit):
-    # Handle graceful shutdown on Ctrl+C or system exit
-    print("\nSimulator stopped.")
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        # Handle graceful shutdown on Ctrl+C or system exit
+        print("\nSimulator stopped.")